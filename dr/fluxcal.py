@@ -3139,49 +3139,64 @@ def rebin_IFU( targetwl, originalwl, datain, varin ):
     binlimits[ -1 ] = targetwl[ -1 ]
     binwidths = np.diff( binlimits )
 
-    origbinindex = np.interp( binlimits, originalbinlimits, 
-                              np.arange( originalbinlimits.shape[0] ),
-                              left=np.nan, right=np.nan )
-
-    fraccounted = np.zeros( originaldata.shape[1] )
-    # use fraccounted to check what fraction of each orig pixel is counted,
-    # and in this way check that flux is conserved.
+    # Fractional index of each new bin limit on the original grid, via
+    # one binary search per edge; same values np.interp against an
+    # arange would give, without the linear-scan interpolation or the
+    # arange temporary
+    nearestindex = np.clip(
+        np.searchsorted( originalbinlimits, binlimits, side='right' ) - 1,
+        0, originalbinlimits.shape[0]-2 )
+    origbinindex = ( nearestindex
+                     + ( binlimits - originalbinlimits[ nearestindex ] )
+                     / ( originalbinlimits[ nearestindex+1 ]
+                         - originalbinlimits[ nearestindex ] ) )
+    origbinindex = np.where( ( binlimits < originalbinlimits[ 0 ] )
+                             | ( binlimits > originalbinlimits[ -1 ] ),
+                             np.nan, origbinindex )
 
     maximumindex = np.max( np.where( np.isfinite( origbinindex ) ) )
 
+    # Prefix sums along wavelength: the whole-pixel contribution to each
+    # new bin then comes from two column lookups instead of a weighted
+    # fancy-indexed gather, leaving only the two fractional edge columns
+    zerocolumn = np.zeros( (originaldata.shape[0], 1) )
+    fluxcum   = np.hstack( (zerocolumn, np.cumsum( originalflux,   axis=1 )) )
+    varcum    = np.hstack( (zerocolumn, np.cumsum( originalvar,    axis=1 )) )
+    weightcum = np.hstack( (zerocolumn, np.cumsum( originalweight, axis=1 )) )
+
     for i, origindex in enumerate( origbinindex[ :-1 ] ):
       if np.isfinite( origindex ) :
-        # deal with the lowest orig bin, which straddles the new lower limit
         lowlimit = int( origindex )
-        lowfrac = 1. - ( origindex % 1 )
-
-        indices = np.array( [ lowlimit] )
-        weights = np.array( [ lowfrac ] )
-
-        # deal with the orig bins that fall entirely within the new bin
+        lowfrac = 1. - ( origindex - np.floor( origindex ) )
         if np.isfinite( origbinindex[i+1] ):
-            intermediate = np.arange( int( origindex )+1, \
-                                  int(origbinindex[i+1]) )
+            upplimit = int( origbinindex[i+1] )
+            uppfrac = origbinindex[ i+1 ] - np.floor( origbinindex[ i+1 ] )
         else :
-            intermediate = np.arange( int( origindex )+1, \
-                                        maximumindex )
-#        print intermediate.shape
-#        print intermediate
-        indices = np.hstack( ( indices, intermediate ) )
-        weights = np.hstack( ( weights, np.ones( intermediate.shape ) ) )
-
-        # deal with the highest orig bin, which straddles the new upper limit
+            # matches the old empty-arange behaviour when maximumindex
+            # falls at or below the lower straddling pixel
+            upplimit = max( maximumindex, lowlimit+1 )
+            uppfrac = 0.
+
+        # interior pixels at full weight from the prefix sums, plus the
+        # fractional straddling pixel at the lower edge...
+        rebinneddata[ :, i ] = ( fluxcum[ :, upplimit ]
+                                 - fluxcum[ :, lowlimit+1 ]
+                                 + lowfrac * originalflux[ :, lowlimit ] )
+        rebinnedvar[  :, i ] = ( varcum[ :, upplimit ]
+                                 - varcum[ :, lowlimit+1 ]
+                                 + lowfrac * originalvar[ :, lowlimit ] )
+        rebinnedweight[:,i ] = ( weightcum[ :, upplimit ]
+                                 - weightcum[ :, lowlimit+1 ]
+                                 + lowfrac * originalweight[ :, lowlimit ] )
+
+        # ...and at the upper edge, when the new bin has one.
+        # The formula also gets the corner case right where the new bin
+        # sits entirely within a single orig bin: the interior term then
+        # comes out -1 pixel, cancelling the double-counted edges.
         if np.isfinite( origbinindex[i+1] ):
-          upplimit = int( origbinindex[i+1] )
-          uppfrac = origbinindex[ i+1 ] % 1
-          indices = np.hstack( ( indices, np.array( [ upplimit ] ) ) )
-          weights = np.hstack( ( weights, np.array( [ uppfrac  ] ) ) )
-
-        fraccounted[ indices ] += weights
-
-        rebinneddata[ :, i ] = np.sum( weights * originalflux[ :, indices ], axis=1 )
-        rebinnedvar[  :, i ] = np.sum( weights * originalvar[  :, indices ], axis=1 )
-        rebinnedweight[:,i ] = np.sum( weights * originalweight[:, indices ], axis=1 )
+            rebinneddata[ :, i ] += uppfrac * originalflux[ :, upplimit ]
+            rebinnedvar[  :, i ] += uppfrac * originalvar[ :, upplimit ]
+            rebinnedweight[:,i ] += uppfrac * originalweight[ :, upplimit ]
 
     # now go back from total flux in each bin to flux per unit wavelength
     rebinneddata = rebinneddata / rebinnedweight 
@@ -3229,48 +3244,45 @@ def rebin_spectrum( targetwl, originalwl, originalspec, originalvarin=None,
     binlimits[ -1 ] = targetwl[ -1 ]
     binwidths = np.diff( binlimits )
 
-    origbinindex = np.interp( binlimits, originalbinlimits, 
-                              np.arange( originalbinlimits.shape[0] ),
-                              left=np.nan, right=np.nan )
-
-    fraccounted = np.zeros( originaldata.shape[0] )
-    # use fraccounted to check what fraction of each orig pixel is counted,
-    # and in this way check that flux is conserved.
-
-    maximumindex = np.max( np.where( np.isfinite( origbinindex ) ) )
-
-    for i, origindex in enumerate( origbinindex ):
-        if np.isfinite( origindex ) :
-            # deal with the lowest orig bin, which straddles the new lower limit
-            lowlimit = int( origindex )
-            lowfrac = 1. - ( origindex % 1 )
-            indices = np.array( [ lowlimit] )
-            weights = np.array( [ lowfrac ] )
-
-            # deal with the orig bins that fall entirely within the new bin
-            if np.isfinite( origbinindex[i+1] ):
-                intermediate = np.arange( int( origindex )+1, \
-                                      int(origbinindex[i+1]) )
-            else :
-                # XXX This is wrong: maximumindex is in the wrong scale
-                #intermediate = np.arange( int( origindex )+1, \
-                #                            maximumindex )
-                # This may also be wrong, but at least it doesn't crash
-                intermediate = np.arange(0)
-            indices = np.hstack( ( indices, intermediate ) )
-            weights = np.hstack( ( weights, np.ones( intermediate.shape ) ) )
-
-            # deal with the highest orig bin, which straddles the new upper limit
-            if np.isfinite( origbinindex[i+1] ):
-                upplimit = int( origbinindex[i+1] )
-                uppfrac = origbinindex[ i+1 ] % 1
-                indices = np.hstack( ( indices, np.array( [ upplimit ] ) ) )
-                weights = np.hstack( ( weights, np.array( [ uppfrac  ] ) ) )
-
-            fraccounted[ indices ] += weights
-            rebinneddata[ i ] = np.sum( weights * originalflux[ :, indices ] )
-            rebinnedvar[  i ] = np.sum( weights * originalvar[  :, indices ] )
-            rebinnedweight[i ]= np.sum( weights * originalweight[:,indices ] )
+    # Fractional index of each new bin limit on the original grid, via
+    # one binary search per edge; same values np.interp against an
+    # arange would give, without the linear-scan interpolation or the
+    # arange temporary
+    nearestindex = np.clip(
+        np.searchsorted( originalbinlimits, binlimits, side='right' ) - 1,
+        0, originalbinlimits.shape[0]-2 )
+    origbinindex = ( nearestindex
+                     + ( binlimits - originalbinlimits[ nearestindex ] )
+                     / ( originalbinlimits[ nearestindex+1 ]
+                         - originalbinlimits[ nearestindex ] ) )
+
+    # Only bins with both limits inside the source coverage get a value;
+    # partially covered bins at either end come out empty (0/0 below).
+    # The loop bounds themselves encode validity, so no per-iteration
+    # finiteness checks (or NaN-filled out-of-range indices) are needed.
+    istart = np.searchsorted( binlimits, originalbinlimits[ 0 ],
+                              side='left' )
+    iend = np.searchsorted( binlimits, originalbinlimits[ -1 ],
+                            side='right' ) - 1
+    for i in range( istart, min( iend, nowlsteps ) ):
+        origindex = origbinindex[ i ]
+        # One index/weight buffer per new bin: full weight for the
+        # orig bins that fall entirely inside it, fractional weight
+        # for the two orig bins straddling its limits
+        lowlimit = int( origindex )
+        lowfrac = 1. - ( origindex - np.floor( origindex ) )
+        upplimit = int( origbinindex[i+1] )
+        uppfrac = origbinindex[ i+1 ] - np.floor( origbinindex[ i+1 ] )
+        indices = np.arange( lowlimit, upplimit+1 )
+        weights = np.ones( indices.shape[0] )
+        weights[ 0 ] = lowfrac
+        # += rather than =, so that a new bin contained within a
+        # single orig bin gets the actual overlap fraction
+        weights[ -1 ] += uppfrac - 1.
+
+        rebinneddata[ i ] = np.sum( weights * originalflux[ :, indices ] )
+        rebinnedvar[  i ] = np.sum( weights * originalvar[  :, indices ] )
+        rebinnedweight[i ]= np.sum( weights * originalweight[:,indices ] )
 
     # now go back from total flux in each bin to flux per unit wavelength
     rebinneddata = rebinneddata / rebinnedweight 
@@ -50,11 +50,14 @@ so can be extended for further models quite straightforwardly.
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import functools
 import os
 import warnings
+from collections import namedtuple
 
 import numpy as np
-from scipy.optimize import leastsq, curve_fit
+from scipy.optimize import least_squares
+from scipy import sparse
 from scipy.interpolate import LSQUnivariateSpline
 from scipy.ndimage.filters import median_filter, gaussian_filter1d
 from scipy.ndimage import zoom
@@ -69,6 +72,7 @@ from astropy import __version__ as ASTROPY_VERSION
 import astropy.units as u
 from astropy.time import Time
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz
+from scipy.signal import fftconvolve
 from scipy.special import erfc
 from scipy.stats import binned_statistic
 from shutil import copyfile
@@ -92,6 +96,13 @@ except ImportError:
     from numpy import nansum, nanmean
     warnings.warn("Not Using bottleneck: Speed will be improved if you install bott    leneck")
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+    warnings.warn("Not using numba: Speed will be improved if you install numba")
+
 # import of ppxf for fitting of secondary stds:
 import ppxf as ppxf_package
 from ppxf.ppxf import ppxf
@@ -115,22 +126,31 @@ TELLURIC_BANDS = np.array([[6850, 6960],
                            [7560, 7770], 
                            [8100, 8360]])
 
+# Set to True to verify flux conservation of each newly built rebinning
+# matrix (see _check_flux_conservation)
+CHECK_FLUX_CONSERVATION = False
+
 def generate_subgrid(fibre_radius, n_inner=6, n_rings=10, wt_profile=False):
     """Generate a subgrid of points within a fibre."""
     radii = np.arange(0., n_rings) + 0.5
+    n_points_ring = np.round(n_inner * radii).astype(np.int64)
+    n_points = int(n_points_ring.sum())
+    radius = np.empty(n_points, dtype=np.float64)
+    theta = np.empty(n_points, dtype=np.float64)
     rot_angle = 0.0
-    radius = []
-    theta = []
-    for i_ring, radius_ring in enumerate(radii):
-        n_points = np.int(np.round(n_inner * radius_ring))
-        theta_ring = (np.linspace(0.0, 2.0*np.pi, n_points, endpoint=False) + 
+    start = 0
+    for radius_ring, n_points_this in zip(radii, n_points_ring):
+        theta_ring = (np.linspace(0.0, 2.0*np.pi, n_points_this,
+                                  endpoint=False) +
                       rot_angle)
-        radius = np.hstack((radius, np.ones(n_points) * radius_ring))
-        theta = np.hstack((theta, theta_ring))
+        radius[start:start+n_points_this] = radius_ring
+        theta[start:start+n_points_this] = theta_ring
+        start += n_points_this
         rot_angle += theta_ring[1] / 2.0
     radius *= fibre_radius / n_rings
-    xsub = radius * np.cos(theta)
-    ysub = radius * np.sin(theta)
+    # Contiguous float64 arrays, as required by the jitted Moffat kernels
+    xsub = np.ascontiguousarray(radius * np.cos(theta), dtype=np.float64)
+    ysub = np.ascontiguousarray(radius * np.sin(theta), dtype=np.float64)
     # generate a weight for the points based on the radial profile.  In this case
     # we use an error function that goes to 0.5 at 0.8 of the radius of the fibre.
     # this is just experimental, no evidence it makes much improvement:
@@ -140,12 +160,108 @@ def generate_subgrid(fibre_radius, n_inner=6, n_rings=10, wt_profile=False):
         wsub = wsub * wnorm
     else:
         # or unit weighting:
-        wsub = np.ones(np.size(xsub)) 
-    return xsub, ysub, wsub
+        wsub = np.ones(n_points)
+    return xsub, ysub, np.ascontiguousarray(wsub, dtype=np.float64)
 
 XSUB, YSUB, WSUB= generate_subgrid(FIBRE_RADIUS)
 N_SUB = len(XSUB)
 
+if njit is not None:
+    # Explicit signatures make numba compile the kernels eagerly at
+    # import and, with cache=True, reload the compiled code from the
+    # on-disk cache in later runs instead of re-JITing; nogil lets them
+    # run from threads without holding the interpreter lock.
+    @njit("f8[:](f8[::1], f8[::1], f8[::1], f8[::1], f8[::1], "
+          "f8, f8, f8, f8, f8, f8)",
+          cache=True, fastmath=True, nogil=True)
+    def _moffat_subgrid(xfibre, yfibre, xsub, ysub, wsub, xcen, ycen,
+                        alphax, alphay, beta, rho):
+        """Accumulate the subgrid-averaged Moffat flux for each fibre.
+
+        Fused version of the non-simple branch of moffat_normalised: the
+        mean over subgrid points is accumulated in a single loop, without
+        building any (N_SUB, n_fibre) intermediate arrays.
+        """
+        n_fibre = xfibre.shape[0]
+        n_sub = xsub.shape[0]
+        norm = ((beta - 1.0) /
+                (np.pi * alphax * alphay * np.sqrt(1.0 - rho**2)) *
+                np.pi * FIBRE_RADIUS**2)
+        flux = np.empty(n_fibre)
+        for i_fibre in range(n_fibre):
+            total = 0.0
+            for i_sub in range(n_sub):
+                xterm = (xfibre[i_fibre] + xsub[i_sub] - xcen) / alphax
+                yterm = (yfibre[i_fibre] + ysub[i_sub] - ycen) / alphay
+                total += wsub[i_sub] * (
+                    1.0 + ((xterm**2 + yterm**2 - 2.0 * rho * xterm * yterm) /
+                           (1.0 - rho**2))) ** (-1.0 * beta)
+            flux[i_fibre] = norm * total / n_sub
+        return flux
+else:
+    _moffat_subgrid = None
+
+if njit is not None:
+    @njit("f8[:, ::1](f8[::1], f8[::1], f8[::1], f8[::1], f8[::1], "
+          "f8[::1], f8[::1], f8[::1], f8[::1], f8[::1], f8[::1], "
+          "f8[::1], f8[::1], f8[:, ::1])",
+          cache=True, fastmath=True, nogil=True)
+    def _moffat_flux_slices(xfibre, yfibre, xsub, ysub, wsub, xcen, ycen,
+                            alphax, alphay, beta, rho, flux_par, background,
+                            out):
+        """Accumulate Moffat flux for all fibres and wavelength slices."""
+        n_fibre = xfibre.shape[0]
+        n_slice = xcen.shape[0]
+        n_sub = xsub.shape[0]
+        for i_slice in range(n_slice):
+            norm = ((beta[i_slice] - 1.0) /
+                    (np.pi * alphax[i_slice] * alphay[i_slice] *
+                     np.sqrt(1.0 - rho[i_slice]**2)) *
+                    np.pi * FIBRE_RADIUS**2)
+            for i_fibre in range(n_fibre):
+                total = 0.0
+                for i_sub in range(n_sub):
+                    xterm = ((xfibre[i_fibre] + xsub[i_sub] - xcen[i_slice]) /
+                             alphax[i_slice])
+                    yterm = ((yfibre[i_fibre] + ysub[i_sub] - ycen[i_slice]) /
+                             alphay[i_slice])
+                    total += wsub[i_sub] * (
+                        1.0 + ((xterm**2 + yterm**2 -
+                                2.0 * rho[i_slice] * xterm * yterm) /
+                               (1.0 - rho[i_slice]**2))) ** (-1.0 *
+                                                             beta[i_slice])
+                out[i_fibre, i_slice] = (
+                    flux_par[i_slice] * norm * total / n_sub +
+                    background[i_slice])
+        return out
+else:
+    _moffat_flux_slices = None
+
+def _moffat_flux_broadcast(xfibre, yfibre, xcen, ycen, alphax, alphay,
+                           beta, rho, flux_par, background, out, block=256):
+    """Moffat flux for all slices at once, via numpy broadcasting.
+
+    The subgrid is broadcast against fibres and wavelength slices in a
+    single (N_SUB, n_fibre, n_slice) expression, processed in blocks of
+    slices to keep the temporary arrays a reasonable size.
+    """
+    n_fibre = xfibre.size
+    n_slice = xcen.size
+    norm = ((beta - 1.0) /
+            (np.pi * alphax * alphay * np.sqrt(1.0 - rho**2)) *
+            np.pi * FIBRE_RADIUS**2)
+    xfibre_sub = xfibre[None, :, None] + XSUB[:, None, None]
+    yfibre_sub = yfibre[None, :, None] + YSUB[:, None, None]
+    for start in range(0, n_slice, block):
+        cut = slice(start, min(start + block, n_slice))
+        xterm = (xfibre_sub - xcen[cut]) / alphax[cut]
+        yterm = (yfibre_sub - ycen[cut]) / alphay[cut]
+        psf = (1.0 + ((xterm**2 + yterm**2 - 2.0 * rho[cut] * xterm * yterm) /
+                      (1.0 - rho[cut]**2))) ** (-1.0 * beta[cut])
+        psf_mean = np.einsum('kfs,k->fs', psf, WSUB) / N_SUB
+        out[:, cut] = flux_par[cut] * norm[cut] * psf_mean + background[cut]
+    return out
+
 def in_telluric_band(wavelength):
     """Return boolean array, True if in a telluric band."""
     retarray = np.zeros(np.shape(wavelength), dtype='bool')
@@ -159,19 +275,22 @@ def read_chunked_data(path_list, probenum, n_drop=None, n_chunk=None,
     """Read flux from a list of files, chunk it and combine."""
     if isinstance(path_list, str):
         path_list = [path_list]
-    for i_file, path in enumerate(path_list):
+    # Collect per-file chunks in lists and concatenate once at the end,
+    # rather than growing the arrays with repeated np.hstack
+    data_list = []
+    variance_list = []
+    wavelength_list = []
+    for path in path_list:
         ifu = IFU(path, probenum, flag_name=False)
         remove_atmosphere(ifu)
         data_i, variance_i, wavelength_i = chunk_data(
             ifu, n_drop=n_drop, n_chunk=n_chunk, sigma_clip=sigma_clip)
-        if i_file == 0:
-            data = data_i
-            variance = variance_i
-            wavelength = wavelength_i
-        else:
-            data = np.hstack((data, data_i))
-            variance = np.hstack((variance, variance_i))
-            wavelength = np.hstack((wavelength, wavelength_i))
+        data_list.append(data_i)
+        variance_list.append(variance_i)
+        wavelength_list.append(wavelength_i)
+    data = np.concatenate(data_list, axis=1)
+    variance = np.concatenate(variance_list, axis=1)
+    wavelength = np.concatenate(wavelength_list, axis=0)
     xfibre = ifu.xpos_rel * np.cos(np.deg2rad(np.mean(ifu.ypos)))
     yfibre = ifu.ypos_rel
     # Only keep unbroken fibres
@@ -225,8 +344,12 @@ def chunk_data(ifu, n_drop=None, n_chunk=None, sigma_clip=None):
     variance = ifu.var[:, start:end].reshape(n_fibre, n_chunk, chunk_size)
     wavelength = ifu.lambda_range[start:end].reshape(n_chunk, chunk_size)
     data = nanmean(data, axis=2)
-    variance = (np.nansum(variance, axis=2) / 
-                np.sum(np.isfinite(variance), axis=2)**2)
+    # Reduce the variance with a single finite mask instead of
+    # traversing the array three times (nansum, isfinite, sum)
+    variance_mask = np.isfinite(variance)
+    variance_count = variance_mask.sum(axis=2)
+    variance = (np.where(variance_mask, variance, 0.0).sum(axis=2) /
+                variance_count.astype(np.float64)**2)
     # Replace any remaining NaNs with 0.0; not ideal but should be very rare
     bad_data = ~np.isfinite(data)
     data[bad_data] = 0.0
@@ -249,49 +372,112 @@ def moffat_normalised(parameters, xfibre, yfibre, simple=False):
                           (1.0 - rho**2))) ** (-1.0 * beta))
         return moffat * np.pi * FIBRE_RADIUS**2
     else:
-        n_fibre = len(xfibre)
-        xfibre_sub = (np.outer(XSUB, np.ones(n_fibre)) + 
-                      np.outer(np.ones(N_SUB), xfibre))
-        yfibre_sub = (np.outer(YSUB, np.ones(n_fibre)) + 
-                      np.outer(np.ones(N_SUB), yfibre))
-        wt_sub = (np.outer(WSUB, np.ones(n_fibre)))
-        flux_sub = moffat_normalised(parameters, xfibre_sub, yfibre_sub, 
+        if _moffat_subgrid is not None:
+            return _moffat_subgrid(
+                np.ascontiguousarray(xfibre, dtype=np.float64),
+                np.ascontiguousarray(yfibre, dtype=np.float64),
+                XSUB, YSUB, WSUB,
+                float(parameters['xcen']), float(parameters['ycen']),
+                float(parameters['alphax']), float(parameters['alphay']),
+                float(parameters['beta']), float(parameters['rho']))
+        # Broadcast instead of materializing outer products with np.ones;
+        # same values, half the allocator traffic
+        xfibre_sub = XSUB[:, None] + np.asarray(xfibre)[None, :]
+        yfibre_sub = YSUB[:, None] + np.asarray(yfibre)[None, :]
+        flux_sub = moffat_normalised(parameters, xfibre_sub, yfibre_sub,
                                      simple=True)
-        flux_sub = flux_sub * wt_sub
-        
-        return np.mean(flux_sub, axis=0)
+        flux_sub *= WSUB[:, None]
 
-def moffat_flux(parameters_array, xfibre, yfibre):
-    """Return n_fibre X n_wavelength array of Moffat function flux values."""
-    n_slice = len(parameters_array)
-    n_fibre = len(xfibre)
-    flux = np.zeros((n_fibre, n_slice))
-    for i_slice, parameters_slice in enumerate(parameters_array):
-        fibre_psf = moffat_normalised(parameters_slice, xfibre, yfibre)
-        flux[:, i_slice] = (parameters_slice['flux'] * fibre_psf + 
-                            parameters_slice['background'])
-    return flux
-
-def model_flux(parameters_dict, xfibre, yfibre, wavelength, model_name):
+        return flux_sub.sum(axis=0) * (1.0 / N_SUB)
+
+def moffat_flux(parameters_array, xfibre, yfibre, out=None):
+    """Return n_fibre X n_wavelength array of Moffat function flux values.
+
+    If `out` is given it must be a contiguous float64 array of shape
+    (n_fibre, n_wavelength); the flux values are written into it and it
+    is returned, avoiding a fresh allocation per call.
+    """
+    xfibre = np.ascontiguousarray(xfibre, dtype=np.float64)
+    yfibre = np.ascontiguousarray(yfibre, dtype=np.float64)
+    # Copy the structured-array fields into contiguous 1-d arrays, so the
+    # whole set of wavelength slices can be evaluated in one pass
+    args = tuple(np.ascontiguousarray(parameters_array[name])
+                 for name in ('xcen', 'ycen', 'alphax', 'alphay', 'beta',
+                              'rho', 'flux', 'background'))
+    if out is None:
+        out = np.empty((xfibre.size, len(parameters_array)))
+    if _moffat_flux_slices is not None:
+        return _moffat_flux_slices(xfibre, yfibre, XSUB, YSUB, WSUB, *args,
+                                   out)
+    return _moffat_flux_broadcast(xfibre, yfibre, *args, out)
+
+def model_flux(parameters_dict, xfibre, yfibre, wavelength, model_name,
+               precomputed=None, out=None):
     """Return n_fibre X n_wavelength array of model flux values."""
     parameters_array = parameters_dict_to_array(parameters_dict, wavelength,
-                                                model_name)
-    return moffat_flux(parameters_array, xfibre, yfibre)
+                                                model_name,
+                                                precomputed=precomputed)
+    return moffat_flux(parameters_array, xfibre, yfibre, out=out)
 
-def residual(parameters_vector, datatube, vartube, xfibre, yfibre,
-             wavelength, model_name, fixed_parameters=None, secondary=False):
-    """Return the residual in each fibre for the given model."""
-    parameters_dict = parameters_vector_to_dict(parameters_vector, model_name)
-    parameters_dict = insert_fixed_parameters(parameters_dict, 
-                                              fixed_parameters)
-    model = model_flux(parameters_dict, xfibre, yfibre, wavelength, model_name)
+def precompute_model_quantities(wavelength, fixed_parameters=None):
+    """Return per-wavelength quantities that are fixed across a fit.
+
+    These depend only on the wavelength array (and, for the hdratm
+    models, on the fixed atmospheric conditions), so they can be
+    evaluated once per fit_model_flux call instead of once per residual
+    evaluation.
+    """
+    precomputed = {
+        'alpha_factor': (wavelength / REFERENCE_WAVELENGTH)**(-0.2)}
+    if (fixed_parameters is not None and
+            'temperature' in fixed_parameters and
+            'pressure' in fixed_parameters and
+            'vapour_pressure' in fixed_parameters):
+        # dar() is separable into a wavelength-dependent amplitude times
+        # tan(zenith_distance); evaluating at 45 degrees gives the
+        # amplitude directly
+        precomputed['atmosphere'] = (fixed_parameters['temperature'],
+                                     fixed_parameters['pressure'],
+                                     fixed_parameters['vapour_pressure'])
+        precomputed['dar_amplitude'] = dar_amplitude(
+            wavelength,
+            temperature=fixed_parameters['temperature'],
+            pressure=fixed_parameters['pressure'],
+            vapour_pressure=fixed_parameters['vapour_pressure'])
+    return precomputed
+
+def _inverse_sigma(datatube, vartube, secondary=False):
+    """Return 1/sigma weights for the fit residuals."""
     # 2dfdr variance is just plain wrong for fibres with little or no flux!
     # Try replacing with something like sqrt(flux), but with a floor
     if (secondary):
         vartube = datatube.copy()
         cutoff = 0.05 * datatube.max()
         vartube[datatube < cutoff] = cutoff
-    res = np.ravel((model - datatube) / np.sqrt(vartube))
+    return np.where(vartube > 0, 1.0 / np.sqrt(vartube), 0.0)
+
+def residual(parameters_vector, datatube, vartube, xfibre, yfibre,
+             wavelength, model_name, fixed_parameters=None, secondary=False,
+             precomputed=None):
+    """Return the residual in each fibre for the given model."""
+    parameters_dict = parameters_vector_to_dict(parameters_vector, model_name)
+    parameters_dict = insert_fixed_parameters(parameters_dict,
+                                              fixed_parameters)
+    if precomputed is not None:
+        model_buf = precomputed.get('model_buf')
+    else:
+        model_buf = None
+    model = model_flux(parameters_dict, xfibre, yfibre, wavelength, model_name,
+                       precomputed=precomputed, out=model_buf)
+    if precomputed is not None and 'inv_sigma' in precomputed:
+        inv_sigma = precomputed['inv_sigma']
+    else:
+        inv_sigma = _inverse_sigma(datatube, vartube, secondary)
+    # model is scratch at this point, so subtract in place; the final
+    # multiply makes a fresh array, as the trust-region solver compares
+    # residuals from successive calls and must not see them aliased
+    np.subtract(model, datatube, out=model)
+    res = np.ravel(model * inv_sigma)
     # Really crude way of putting bounds on the value of alpha
     if 'alpha_ref' in parameters_dict:
         if parameters_dict['alpha_ref'] < 0.5:
@@ -303,16 +489,123 @@ def residual(parameters_vector, datatube, vartube, xfibre, yfibre,
             res *= 1e10*(1.01 - parameters_dict['beta'])
     return res
 
+def jacobian(parameters_vector, datatube, vartube, xfibre, yfibre,
+             wavelength, model_name, fixed_parameters=None, secondary=False,
+             precomputed=None):
+    """Return the Jacobian of residual() at the given parameters.
+
+    The flux and background parameters enter the model linearly, so their
+    columns come for free from a single PSF evaluation. Only the handful
+    of shared model parameters (centre, zenith terms, alpha, beta, ...)
+    are done by forward differences, one model evaluation each. Compare
+    with the (2 * n_slice + n_shared) full model evaluations per
+    Levenberg-Marquardt step that leastsq spends when left to construct
+    the Jacobian itself.
+    """
+    n_parameters = len(parameters_vector)
+    parameters_dict = parameters_vector_to_dict(parameters_vector, model_name)
+    parameters_dict = insert_fixed_parameters(parameters_dict,
+                                              fixed_parameters)
+    n_slice = len(parameters_dict['flux'])
+    n_shared = n_parameters - 2 * n_slice
+    if precomputed is not None and 'inv_sigma' in precomputed:
+        inv_sigma = precomputed['inv_sigma']
+    else:
+        inv_sigma = _inverse_sigma(datatube, vartube, secondary)
+    # Evaluate the PSF with unit flux and zero background; this provides
+    # both the model itself and the flux/background columns
+    parameters_array = parameters_dict_to_array(parameters_dict, wavelength,
+                                                model_name,
+                                                precomputed=precomputed)
+    psf_array = parameters_array.copy()
+    psf_array['flux'] = 1.0
+    psf_array['background'] = 0.0
+    psf = moffat_flux(psf_array, xfibre, yfibre)
+    model = parameters_array['flux'] * psf + parameters_array['background']
+    n_fibre = len(xfibre)
+    inv_sigma = np.broadcast_to(inv_sigma, (n_fibre, n_slice))
+    # Forward differences for the shared (non-linear) parameters
+    tail = np.empty((n_fibre, n_slice, n_shared))
+    for i_shared in range(n_shared):
+        index = 2 * n_slice + i_shared
+        step = (np.sqrt(np.finfo(np.float64).eps) *
+                max(abs(parameters_vector[index]), 1.0))
+        vector_step = np.array(parameters_vector, dtype=np.float64)
+        vector_step[index] += step
+        dict_step = insert_fixed_parameters(
+            parameters_vector_to_dict(vector_step, model_name),
+            fixed_parameters)
+        # The stepped model is consumed immediately, so the scratch
+        # buffer can be recycled for every difference
+        model_step = model_flux(
+            dict_step, xfibre, yfibre, wavelength, model_name,
+            precomputed=precomputed,
+            out=None if precomputed is None else precomputed.get('model_buf'))
+        tail[:, :, i_shared] = (model_step - model) * inv_sigma / step
+    # The Jacobian is block sparse: flux[s] and background[s] only touch
+    # the residuals in slice s, so assemble it directly in sparse form
+    # and let the solver exploit the structure.
+    n_data = n_fibre * n_slice
+    row = np.arange(n_data)
+    col_flux = np.tile(np.arange(n_slice), n_fibre)
+    rows = np.concatenate((row, row, np.repeat(row, n_shared)))
+    cols = np.concatenate((col_flux, n_slice + col_flux,
+                           np.tile(2 * n_slice + np.arange(n_shared),
+                                   n_data)))
+    data = np.concatenate(((psf * inv_sigma).ravel(), inv_sigma.ravel(),
+                           tail.reshape(n_data, n_shared).ravel()))
+    jac = sparse.coo_matrix((data, (rows, cols)),
+                            shape=(n_data, n_parameters)).tocsr()
+    # Mirror the crude alpha/beta bounds applied in residual(). The
+    # derivative of the penalty factor itself is ignored; inside the
+    # allowed region the factor is 1 and this is exact.
+    if 'alpha_ref' in parameters_dict:
+        if parameters_dict['alpha_ref'] < 0.5:
+            jac *= 1e10 * (0.5 - parameters_dict['alpha_ref'])
+        elif parameters_dict['alpha_ref'] > 5.0:
+            jac *= 1e10 * (parameters_dict['alpha_ref'] - 5.0)
+    if 'beta' in parameters_dict:
+        if parameters_dict['beta'] <= 1.0:
+            jac *= 1e10*(1.01 - parameters_dict['beta'])
+    return jac
+
+def parameter_bounds(n_parameters, model_name):
+    """Return (lower, upper) bounds on the parameter vector for a model."""
+    lower = np.full(n_parameters, -np.inf)
+    upper = np.full(n_parameters, np.inf)
+    # Same limits that residual() imposes through its penalty factors;
+    # giving them to the solver keeps the penalties from ever triggering.
+    tail = model_spec(model_name).tail_parameters
+    n_tail = len(tail)
+    if 'alpha_ref' in tail:
+        index_alpha = tail.index('alpha_ref') - n_tail
+        lower[index_alpha] = 0.5
+        upper[index_alpha] = 5.0
+    index_beta = tail.index('beta') - n_tail
+    lower[index_beta] = 1.0
+    return lower, upper
+
 def fit_model_flux(datatube, vartube, xfibre, yfibre, wavelength, model_name,
                    fixed_parameters=None, secondary=False):
     """Fit a model to the given datatube."""
-    par_0_dict = first_guess_parameters(datatube, vartube, xfibre, yfibre, 
+    par_0_dict = first_guess_parameters(datatube, vartube, xfibre, yfibre,
                                         wavelength, model_name)
     par_0_vector = parameters_dict_to_vector(par_0_dict, model_name)
+    precomputed = precompute_model_quantities(wavelength, fixed_parameters)
+    # The weights are fixed across the fit; compute them once rather
+    # than taking a sqrt of the full variance array per iteration
+    precomputed['inv_sigma'] = _inverse_sigma(datatube, vartube, secondary)
+    # Scratch buffer for the model evaluation in residual(), reused
+    # across iterations instead of reallocated each call
+    precomputed['model_buf'] = np.empty((len(xfibre), len(wavelength)))
     args = (datatube, vartube, xfibre, yfibre, wavelength, model_name,
-            fixed_parameters, secondary)
-    parameters_vector = leastsq(residual, par_0_vector, args=args)[0]
-    parameters_dict = parameters_vector_to_dict(parameters_vector, model_name)
+            fixed_parameters, secondary, precomputed)
+    result = least_squares(
+        residual, par_0_vector, jac=jacobian, method='trf',
+        tr_solver='lsmr', bounds=parameter_bounds(len(par_0_vector),
+                                                  model_name),
+        args=args)
+    parameters_dict = parameters_vector_to_dict(result.x, model_name)
     return parameters_dict
 
 def first_guess_parameters(datatube, vartube, xfibre, yfibre, wavelength, 
@@ -386,146 +679,83 @@ def first_guess_parameters(datatube, vartube, xfibre, yfibre, wavelength,
         raise KeyError('Unrecognised model name: ' + model_name)
     return par_0
 
+# The parameter vector for every model is laid out as
+# [flux(n_slice), background(n_slice), tail...]; the tail order below
+# defines the vector layout, so don't reorder it for existing models.
+ModelSpec = namedtuple('ModelSpec', ['tail_parameters'])
+
+_MODEL_SPECS = {
+    'ref_centre_alpha_angle': ModelSpec(
+        ('xcen_ref', 'ycen_ref', 'zenith_direction', 'zenith_distance',
+         'alphax_ref', 'alphay_ref', 'beta', 'rho')),
+    'ref_centre_alpha_angle_circ': ModelSpec(
+        ('xcen_ref', 'ycen_ref', 'zenith_direction', 'zenith_distance',
+         'alpha_ref', 'beta')),
+    'ref_centre_alpha_dist_circ': ModelSpec(
+        ('xcen_ref', 'ycen_ref', 'zenith_distance', 'alpha_ref', 'beta')),
+    'ref_centre_alpha_dist_circ_hdratm': ModelSpec(
+        ('xcen_ref', 'ycen_ref', 'zenith_distance', 'alpha_ref', 'beta')),
+    'ref_centre_alpha_angle_circ_atm': ModelSpec(
+        ('temperature', 'pressure', 'vapour_pressure', 'xcen_ref',
+         'ycen_ref', 'zenith_direction', 'zenith_distance', 'alpha_ref',
+         'beta')),
+    'ref_centre_alpha_circ_hdratm': ModelSpec(
+        ('xcen_ref', 'ycen_ref', 'alpha_ref', 'beta')),
+    }
+
+def model_spec(model_name):
+    """Return the ModelSpec for a model name."""
+    try:
+        return _MODEL_SPECS[model_name]
+    except KeyError:
+        raise KeyError('Unrecognised model name: ' + model_name)
+
 def parameters_dict_to_vector(parameters_dict, model_name):
     """Convert a parameters dictionary to a vector."""
-    if model_name == 'ref_centre_alpha_angle':
-        parameters_vector = np.hstack(
-            (parameters_dict['flux'],
-             parameters_dict['background'],
-             parameters_dict['xcen_ref'],
-             parameters_dict['ycen_ref'],
-             parameters_dict['zenith_direction'],
-             parameters_dict['zenith_distance'],
-             parameters_dict['alphax_ref'],
-             parameters_dict['alphay_ref'],
-             parameters_dict['beta'],
-             parameters_dict['rho']))
-    elif model_name == 'ref_centre_alpha_angle_circ':
-        parameters_vector = np.hstack(
-            (parameters_dict['flux'],
-             parameters_dict['background'],
-             parameters_dict['xcen_ref'],
-             parameters_dict['ycen_ref'],
-             parameters_dict['zenith_direction'],
-             parameters_dict['zenith_distance'],
-             parameters_dict['alpha_ref'],
-             parameters_dict['beta']))
-    elif (model_name == 'ref_centre_alpha_dist_circ' or
-          model_name == 'ref_centre_alpha_dist_circ_hdratm'):
-        parameters_vector = np.hstack(
-            (parameters_dict['flux'],
-             parameters_dict['background'],
-             parameters_dict['xcen_ref'],
-             parameters_dict['ycen_ref'],
-             parameters_dict['zenith_distance'],
-             parameters_dict['alpha_ref'],
-             parameters_dict['beta']))
-    elif model_name == 'ref_centre_alpha_angle_circ_atm':
-        parameters_vector = np.hstack(
-            (parameters_dict['flux'],
-             parameters_dict['background'],
-             parameters_dict['temperature'],
-             parameters_dict['pressure'],
-             parameters_dict['vapour_pressure'],
-             parameters_dict['xcen_ref'],
-             parameters_dict['ycen_ref'],
-             parameters_dict['zenith_direction'],
-             parameters_dict['zenith_distance'],
-             parameters_dict['alpha_ref'],
-             parameters_dict['beta']))
-    elif model_name == 'ref_centre_alpha_circ_hdratm':
-        parameters_vector = np.hstack(
-            (parameters_dict['flux'],
-             parameters_dict['background'],
-             parameters_dict['xcen_ref'],
-             parameters_dict['ycen_ref'],
-             parameters_dict['alpha_ref'],
-             parameters_dict['beta']))
-    else:
-        raise KeyError('Unrecognised model name: ' + model_name)
-    return parameters_vector
+    spec = model_spec(model_name)
+    return np.hstack(
+        (parameters_dict['flux'], parameters_dict['background']) +
+        tuple(parameters_dict[name] for name in spec.tail_parameters))
 
 def parameters_vector_to_dict(parameters_vector, model_name):
     """Convert a parameters vector to a dictionary."""
-    parameters_dict = {}
-    if model_name == 'ref_centre_alpha_angle':
-        n_slice = np.int((len(parameters_vector) - 8) // 2)
-        parameters_dict['flux'] = parameters_vector[0:n_slice]
-        parameters_dict['background'] = parameters_vector[n_slice:2*n_slice]
-        parameters_dict['xcen_ref'] = parameters_vector[-8]
-        parameters_dict['ycen_ref'] = parameters_vector[-7]
-        parameters_dict['zenith_direction'] = parameters_vector[-6]
-        parameters_dict['zenith_distance'] = parameters_vector[-5]
-        parameters_dict['alphax_ref'] = parameters_vector[-4]
-        parameters_dict['alphay_ref'] = parameters_vector[-3]
-        parameters_dict['beta'] = parameters_vector[-2]
-        parameters_dict['rho'] = parameters_vector[-1]
-    elif model_name == 'ref_centre_alpha_angle_circ':
-        n_slice = np.int((len(parameters_vector) - 6) // 2)
-        parameters_dict['flux'] = parameters_vector[0:n_slice]
-        parameters_dict['background'] = parameters_vector[n_slice:2*n_slice]
-        parameters_dict['xcen_ref'] = parameters_vector[-6]
-        parameters_dict['ycen_ref'] = parameters_vector[-5]
-        parameters_dict['zenith_direction'] = parameters_vector[-4]
-        parameters_dict['zenith_distance'] = parameters_vector[-3]
-        parameters_dict['alpha_ref'] = parameters_vector[-2]
-        parameters_dict['beta'] = parameters_vector[-1]
-    elif (model_name == 'ref_centre_alpha_dist_circ' or
-          model_name == 'ref_centre_alpha_dist_circ_hdratm'):
-        n_slice = np.int((len(parameters_vector) - 5) // 2)
-        parameters_dict['flux'] = parameters_vector[0:n_slice]
-        parameters_dict['background'] = parameters_vector[n_slice:2*n_slice]
-        parameters_dict['xcen_ref'] = parameters_vector[-5]
-        parameters_dict['ycen_ref'] = parameters_vector[-4]
-        parameters_dict['zenith_distance'] = parameters_vector[-3]
-        parameters_dict['alpha_ref'] = parameters_vector[-2]
-        parameters_dict['beta'] = parameters_vector[-1]
-    elif model_name == 'ref_centre_alpha_angle_circ_atm':
-        n_slice = np.int((len(parameters_vector) - 9) // 2)
-        parameters_dict['flux'] = parameters_vector[0:n_slice]
-        parameters_dict['background'] = parameters_vector[n_slice:2*n_slice]
-        parameters_dict['temperature'] = parameters_vector[-9]
-        parameters_dict['pressure'] = parameters_vector[-8]
-        parameters_dict['vapour_pressure'] = parameters_vector[-7]
-        parameters_dict['xcen_ref'] = parameters_vector[-6]
-        parameters_dict['ycen_ref'] = parameters_vector[-5]
-        parameters_dict['zenith_direction'] = parameters_vector[-4]
-        parameters_dict['zenith_distance'] = parameters_vector[-3]
-        parameters_dict['alpha_ref'] = parameters_vector[-2]
-        parameters_dict['beta'] = parameters_vector[-1]
-    elif model_name == 'ref_centre_alpha_circ_hdratm':
-        n_slice = np.int((len(parameters_vector) - 4) // 2)
-        parameters_dict['flux'] = parameters_vector[0:n_slice]
-        parameters_dict['background'] = parameters_vector[n_slice:2*n_slice]
-        parameters_dict['xcen_ref'] = parameters_vector[-4]
-        parameters_dict['ycen_ref'] = parameters_vector[-3]
-        parameters_dict['alpha_ref'] = parameters_vector[-2]
-        parameters_dict['beta'] = parameters_vector[-1]
-    else:
-        raise KeyError('Unrecognised model name: ' + model_name)
+    spec = model_spec(model_name)
+    n_tail = len(spec.tail_parameters)
+    n_slice = (len(parameters_vector) - n_tail) // 2
+    parameters_dict = {
+        'flux': parameters_vector[0:n_slice],
+        'background': parameters_vector[n_slice:2*n_slice]}
+    for index, name in enumerate(spec.tail_parameters):
+        parameters_dict[name] = parameters_vector[index - n_tail]
     return parameters_dict
 
-def parameters_dict_to_array(parameters_dict, wavelength, model_name):
+def parameters_dict_to_array(parameters_dict, wavelength, model_name,
+                             precomputed=None):
     parameter_names = ('xcen ycen alphax alphay beta rho flux '
                        'background'.split())
     formats = ['float64'] * len(parameter_names)
     lw = np.size(wavelength)
-    parameters_array = np.zeros(lw, 
-                                dtype={'names':parameter_names, 
+    parameters_array = np.zeros(lw,
+                                dtype={'names':parameter_names,
                                        'formats':formats})
+    if precomputed is not None:
+        alpha_factor = precomputed['alpha_factor']
+    else:
+        alpha_factor = (wavelength / REFERENCE_WAVELENGTH)**(-0.2)
     if model_name == 'ref_centre_alpha_angle':
+        # Evaluate the DAR offsets once; the x and y centres only differ
+        # in the zenith direction factor
+        dar_arr = dar(wavelength, parameters_dict['zenith_distance'])
         parameters_array['xcen'] = (
             parameters_dict['xcen_ref'] +
-            np.sin(parameters_dict['zenith_direction']) * 
-            dar(wavelength, parameters_dict['zenith_distance']))
+            np.sin(parameters_dict['zenith_direction']) * dar_arr)
         parameters_array['ycen'] = (
             parameters_dict['ycen_ref'] +
-            np.cos(parameters_dict['zenith_direction']) * 
-            dar(wavelength, parameters_dict['zenith_distance']))
+            np.cos(parameters_dict['zenith_direction']) * dar_arr)
         parameters_array['alphax'] = (
-            alpha(wavelength, parameters_dict['alphax_ref']))
+            parameters_dict['alphax_ref'] * alpha_factor)
         parameters_array['alphay'] = (
-            alpha(wavelength, parameters_dict['alphay_ref']))
+            parameters_dict['alphay_ref'] * alpha_factor)
         parameters_array['beta'] = parameters_dict['beta']
         parameters_array['rho'] = parameters_dict['rho']
         if len(parameters_dict['flux']) == len(parameters_array):
@@ -534,18 +764,16 @@ def parameters_dict_to_array(parameters_dict, wavelength, model_name):
             parameters_array['background'] = parameters_dict['background']
     elif (model_name == 'ref_centre_alpha_angle_circ' or
           model_name == 'ref_centre_alpha_dist_circ'):
+        dar_arr = dar(wavelength, parameters_dict['zenith_distance'])
         parameters_array['xcen'] = (
-            parameters_dict['xcen_ref'] + 
-            np.sin(parameters_dict['zenith_direction']) * 
-            dar(wavelength, parameters_dict['zenith_distance']))
+            parameters_dict['xcen_ref'] +
+            np.sin(parameters_dict['zenith_direction']) * dar_arr)
         parameters_array['ycen'] = (
-            parameters_dict['ycen_ref'] + 
-            np.cos(parameters_dict['zenith_direction']) * 
-            dar(wavelength, parameters_dict['zenith_distance']))
-        parameters_array['alphax'] = (
-            alpha(wavelength, parameters_dict['alpha_ref']))
-        parameters_array['alphay'] = (
-            alpha(wavelength, parameters_dict['alpha_ref']))
+            parameters_dict['ycen_ref'] +
+            np.cos(parameters_dict['zenith_direction']) * dar_arr)
+        alpha_arr = parameters_dict['alpha_ref'] * alpha_factor
+        parameters_array['alphax'] = alpha_arr
+        parameters_array['alphay'] = alpha_arr
         parameters_array['beta'] = parameters_dict['beta']
         parameters_array['rho'] = np.zeros(lw)
         if len(parameters_dict['flux']) == len(parameters_array):
@@ -555,24 +783,30 @@ def parameters_dict_to_array(parameters_dict, wavelength, model_name):
     elif (model_name == 'ref_centre_alpha_angle_circ_atm' or
           model_name == 'ref_centre_alpha_dist_circ_hdratm' or
           model_name == 'ref_centre_alpha_circ_hdratm'):
+        atmosphere = (parameters_dict['temperature'],
+                      parameters_dict['pressure'],
+                      parameters_dict['vapour_pressure'])
+        if (precomputed is not None and 'dar_amplitude' in precomputed and
+                precomputed['atmosphere'] == atmosphere):
+            # dar() is amplitude * tan(zenith_distance), with the
+            # amplitude already evaluated for these fixed atmospheric
+            # conditions
+            dar_arr = (precomputed['dar_amplitude'] *
+                       np.tan(parameters_dict['zenith_distance']))
+        else:
+            dar_arr = dar(wavelength, parameters_dict['zenith_distance'],
+                          temperature=parameters_dict['temperature'],
+                          pressure=parameters_dict['pressure'],
+                          vapour_pressure=parameters_dict['vapour_pressure'])
         parameters_array['xcen'] = (
             parameters_dict['xcen_ref'] +
-            np.sin(parameters_dict['zenith_direction']) * 
-            dar(wavelength, parameters_dict['zenith_distance'],
-                temperature=parameters_dict['temperature'],
-                pressure=parameters_dict['pressure'],
-                vapour_pressure=parameters_dict['vapour_pressure']))
+            np.sin(parameters_dict['zenith_direction']) * dar_arr)
         parameters_array['ycen'] = (
             parameters_dict['ycen_ref'] +
-            np.cos(parameters_dict['zenith_direction']) * 
-            dar(wavelength, parameters_dict['zenith_distance'],
-                temperature=parameters_dict['temperature'],
-                pressure=parameters_dict['pressure'],
-                vapour_pressure=parameters_dict['vapour_pressure']))
-        parameters_array['alphax'] = (
-            alpha(wavelength, parameters_dict['alpha_ref']))
-        parameters_array['alphay'] = (
-            alpha(wavelength, parameters_dict['alpha_ref']))
+            np.cos(parameters_dict['zenith_direction']) * dar_arr)
+        alpha_arr = parameters_dict['alpha_ref'] * alpha_factor
+        parameters_array['alphax'] = alpha_arr
+        parameters_array['alphay'] = alpha_arr
         parameters_array['beta'] = parameters_dict['beta']
         parameters_array['rho'] = np.zeros(lw)
         if len(parameters_dict['flux']) == len(parameters_array):
@@ -587,15 +821,45 @@ def alpha(wavelength, alpha_ref):
     """Return alpha at the specified wavelength(s)."""
     return alpha_ref * ((wavelength / REFERENCE_WAVELENGTH)**(-0.2))
 
+_DAR_AMPLITUDE_CACHE = {}
+
+def dar_amplitude(wavelength, temperature=None, pressure=None,
+                  vapour_pressure=None):
+    """Return the DAR amplitude, i.e. the offset at tan(zenith_distance)=1.
+
+    The amplitude depends only on the wavelength array and atmospheric
+    conditions, both of which are constant across the many residual
+    evaluations within a single fit, so the result is memoized. The
+    cache is keyed on the raw bytes of the wavelength array, so two
+    different grids can never alias even if one is allocated at the
+    address of the other -- the same scheme as _build_rebin_matrix.
+    """
+    key = (np.asarray(wavelength, dtype=np.float64).tobytes(),
+           temperature, pressure, vapour_pressure)
+    try:
+        return _DAR_AMPLITUDE_CACHE[key]
+    except KeyError:
+        pass
+    amplitude = (adr_r(wavelength, 45.0,
+                       air_pres=pressure, temperature=temperature,
+                       water_pres=vapour_pressure) -
+                 adr_r(REFERENCE_WAVELENGTH, 45.0,
+                       air_pres=pressure, temperature=temperature,
+                       water_pres=vapour_pressure))
+    if len(_DAR_AMPLITUDE_CACHE) >= 8:
+        _DAR_AMPLITUDE_CACHE.clear()
+    _DAR_AMPLITUDE_CACHE[key] = amplitude
+    return amplitude
+
 def dar(wavelength, zenith_distance, temperature=None, pressure=None,
         vapour_pressure=None):
     """Return the DAR offset in arcseconds at the specified wavelength(s)."""
-    return (adr_r(wavelength, np.rad2deg(zenith_distance), 
-                  air_pres=pressure, temperature=temperature, 
-                  water_pres=vapour_pressure) - 
-            adr_r(REFERENCE_WAVELENGTH, np.rad2deg(zenith_distance), 
-                  air_pres=pressure, temperature=temperature, 
-                  water_pres=vapour_pressure))
+    # adr_r is separable into amplitude * tan(zenith_distance); the
+    # amplitude is cached across calls with the same inputs
+    return (dar_amplitude(wavelength, temperature=temperature,
+                          pressure=pressure,
+                          vapour_pressure=vapour_pressure) *
+            np.tan(zenith_distance))
 
 # def dar(wavelength, zenith_distance, temperature=None, pressure=None, 
 #         vapour_pressure=None):
@@ -670,20 +934,27 @@ def derive_transfer_function(path_list, max_sep_arcsec=60.0,
         remove_atmosphere(ifu)
         observed_flux, observed_background, sigma_flux, sigma_background = \
             extract_total_flux(ifu, psf_parameters, model_name)
-        save_extracted_flux(path2, observed_flux, observed_background,
-                            sigma_flux, sigma_background,
-                            star_match, psf_parameters, model_name,
-                            good_psf)
-        transfer_function = take_ratio(
-            standard_data['flux'],
-            standard_data['wavelength'],
-            observed_flux,
-            sigma_flux,
-            ifu.lambda_range,
-            smooth=smooth,
-            mf_av=molecfit_available,
-            tell_corr_primary=tell_corr_primary)
-        save_transfer_function(path2, transfer_function)
+        # Open the output file once and write both the extracted flux
+        # and the transfer function through the same handle; the with
+        # block flushes on every exit path, so the extracted flux is
+        # kept even if deriving the transfer function fails
+        with pf.open(path2, 'update', do_not_scale_image_data=True) \
+                as hdulist:
+            save_extracted_flux(hdulist, observed_flux,
+                                observed_background,
+                                sigma_flux, sigma_background,
+                                star_match, psf_parameters, model_name,
+                                good_psf)
+            transfer_function = take_ratio(
+                standard_data['flux'],
+                standard_data['wavelength'],
+                observed_flux,
+                sigma_flux,
+                ifu.lambda_range,
+                smooth=smooth,
+                mf_av=molecfit_available,
+                tell_corr_primary=tell_corr_primary)
+            save_transfer_function(hdulist, transfer_function)
     return
 
 def match_standard_star(filename, max_sep_arcsec=60.0, 
@@ -714,57 +985,162 @@ def match_standard_star(filename, max_sep_arcsec=60.0,
     # code deal with it.
     return
 
-def match_star_coordinates(ra, dec, max_sep_arcsec=60.0, 
+@functools.lru_cache(maxsize=None)
+def _load_standard_catalogue(index_path):
+    """Parse a standard star catalogue into coordinate arrays, once.
+
+    The catalogues never change within a run, so the parsed form is
+    memoized; building per-row astropy coordinate objects for every
+    probe was by far the slowest part of matching.
+    """
+    converters = {'col6':[ascii.convert_numpy(str)]}
+    index = table.Table.read(index_path, format='ascii.no_header'
+                             ,converters=converters)
+    n_star = len(index)
+    paths = []
+    names = []
+    ra_deg = np.empty(n_star)
+    dec_deg = np.empty(n_star)
+    for i_star, star in enumerate(index):
+        paths.append(os.path.join(os.path.dirname(index_path), star[0]))
+        names.append(star[1])
+        ra_deg[i_star] = 15.0 * (float(star['col3']) +
+                                 float(star['col4']) / 60.0 +
+                                 float(star['col5']) / 3600.0)
+        dec_string = str(star['col6']).strip()
+        sign = -1.0 if dec_string.startswith('-') else 1.0
+        dec_deg[i_star] = sign * (abs(float(dec_string)) +
+                                  float(star['col7']) / 60.0 +
+                                  float(star['col8']) / 3600.0)
+    return paths, names, ra_deg, dec_deg
+
+def match_star_coordinates(ra, dec, max_sep_arcsec=60.0,
                            catalogues=STANDARD_CATALOGUES):
     """Return details of the star nearest to the supplied coordinates."""
     for index_path in catalogues:
-        #index = np.loadtxt(index_path, dtype='S')
-        converters = {'col6':[ascii.convert_numpy(np.str)]}
-        index = table.Table.read(index_path, format='ascii.no_header'
-                                 ,converters=converters)
-        for star in index:
-            RAstring = '%sh%sm%ss' % (star['col3'], star['col4'], star['col5'])
-            Decstring = '%sd%sm%ss' % (star['col6'], star['col7'], star['col8'])
-
-            ra_star = coord.Angle(RAstring, unit=units.hour) 
-            dec_star = coord.Angle(Decstring, unit=units.degree)
-            coords_star = coord.ICRS(ra_star, dec_star)
-
-            ra_tgt = coord.Angle(ra, unit=units.degree)
-            dec_tgt = coord.Angle(dec, unit=units.degree)
-
-            coords = coord.ICRS(ra_tgt, dec_tgt)
-
-            sep = coords.separation(coords_star).arcsec
-
-            if sep < max_sep_arcsec:
-                star_match = {
-                    'path': os.path.join(os.path.dirname(index_path), star[0]),
-                    'name': star[1],
-                    'separation': sep
-                    }
-                return star_match
+        paths, names, ra_star, dec_star = _load_standard_catalogue(index_path)
+        # Small-angle separation; plenty accurate at arcminute scales
+        delta_ra = ((ra_star - ra + 180.0) % 360.0 - 180.0) * \
+            np.cos(np.deg2rad(dec))
+        delta_dec = dec_star - dec
+        sep = 3600.0 * np.sqrt(delta_ra**2 + delta_dec**2)
+        index_closest = np.argmin(sep)
+        if sep[index_closest] < max_sep_arcsec:
+            star_match = {
+                'path': paths[index_closest],
+                'name': names[index_closest],
+                'separation': sep[index_closest]
+                }
+            return star_match
     # No matching star found. Let outer code deal with it.
     return
 
+if njit is not None:
+    @njit(parallel=True, cache=True, nogil=True)
+    def _extract_all(psf_all, data, variance, min_fibre):
+        """Closed-form flux/background solve, parallel over slices.
+
+        Each wavelength slice is independent, so the 2x2 weighted
+        least-squares solves are farmed out across cores with prange.
+        No fastmath here: the kernel skips dead pixels via np.isfinite,
+        and fastmath's no-NaN assumption would let LLVM fold those
+        checks away.
+        """
+        n_fibre, n_slice = data.shape
+        flux = np.empty(n_slice)
+        background = np.empty(n_slice)
+        sigma_flux = np.empty(n_slice)
+        sigma_background = np.empty(n_slice)
+        for i_slice in prange(n_slice):
+            s_w = 0.0
+            s_wm = 0.0
+            s_wmm = 0.0
+            s_wd = 0.0
+            s_wmd = 0.0
+            n_good = 0
+            for i_fibre in range(n_fibre):
+                d = data[i_fibre, i_slice]
+                if np.isfinite(d):
+                    w = 1.0 / variance[i_fibre, i_slice]
+                    m = psf_all[i_fibre, i_slice]
+                    s_w += w
+                    s_wm += w * m
+                    s_wmm += w * m * m
+                    s_wd += w * d
+                    s_wmd += w * m * d
+                    n_good += 1
+            det = s_wmm * s_w - s_wm * s_wm
+            # Require at least half the fibres to perform a fit
+            if n_good <= min_fibre or not np.isfinite(det) or det <= 0.0:
+                flux[i_slice] = np.nan
+                background[i_slice] = np.nan
+                sigma_flux[i_slice] = np.nan
+                sigma_background[i_slice] = np.nan
+            else:
+                flux[i_slice] = (s_w * s_wmd - s_wm * s_wd) / det
+                background[i_slice] = (s_wmm * s_wd - s_wm * s_wmd) / det
+                sigma_flux[i_slice] = np.sqrt(s_w / det)
+                sigma_background[i_slice] = np.sqrt(s_wmm / det)
+        return flux, background, sigma_flux, sigma_background
+else:
+    _extract_all = None
+
+def extract_flux_all(psf_all, data, variance, min_fibre=30):
+    """Closed-form flux/background extraction for all slices at once.
+
+    Vectorized equivalent of calling fit_flux_slice per wavelength
+    pixel: the weighted sums entering the 2x2 normal equations are
+    reduced over the fibre axis for every slice in a handful of numpy
+    calls. Slices with min_fibre or fewer finite fibres come back NaN.
+    With numba installed the solves run in parallel across slices.
+    """
+    if _extract_all is not None:
+        return _extract_all(
+            np.ascontiguousarray(psf_all, dtype=np.float64),
+            np.ascontiguousarray(data, dtype=np.float64),
+            np.ascontiguousarray(variance, dtype=np.float64),
+            min_fibre)
+    good = np.isfinite(data)
+    n_good = good.sum(axis=0)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', r'invalid value', RuntimeWarning)
+        warnings.filterwarnings('ignore', r'divide by zero', RuntimeWarning)
+        weight = np.where(good, 1.0 / variance, 0.0)
+        data_masked = np.where(good, data, 0.0)
+        s_w = weight.sum(axis=0)
+        s_wm = (weight * psf_all).sum(axis=0)
+        s_wmm = (weight * psf_all * psf_all).sum(axis=0)
+        s_wd = (weight * data_masked).sum(axis=0)
+        s_wmd = (weight * psf_all * data_masked).sum(axis=0)
+        det = s_wmm * s_w - s_wm**2
+        flux = (s_w * s_wmd - s_wm * s_wd) / det
+        background = (s_wmm * s_wd - s_wm * s_wmd) / det
+        sigma_flux = np.sqrt(s_w / det)
+        sigma_background = np.sqrt(s_wmm / det)
+        # Require at least half the fibres to perform a fit
+        bad = (n_good <= min_fibre) | ~np.isfinite(det) | (det <= 0)
+    flux[bad] = np.nan
+    background[bad] = np.nan
+    sigma_flux[bad] = np.nan
+    sigma_background[bad] = np.nan
+    return flux, background, sigma_flux, sigma_background
+
 def extract_total_flux(ifu, psf_parameters, model_name, clip=None):
     """Extract the total flux, including light between fibres."""
     psf_parameters_array = parameters_dict_to_array(
         psf_parameters, ifu.lambda_range, model_name)
     n_pixel = len(psf_parameters_array)
-    flux = np.zeros(n_pixel)
-    background = np.zeros(n_pixel)
-    sigma_flux = np.zeros(n_pixel)
-    sigma_background = np.zeros(n_pixel)
     good_fibre = (ifu.fib_type == 'P')
     xfibre = ifu.xpos_rel * np.cos(np.deg2rad(np.mean(ifu.ypos)))
     yfibre = ifu.ypos_rel
-    for index, psf_parameters_slice in enumerate(psf_parameters_array):
-        flux[index], background[index], sigma_flux[index], \
-            sigma_background[index] = extract_flux_slice(
-                ifu.data[good_fibre, index], ifu.var[good_fibre, index], 
-                xfibre[good_fibre], yfibre[good_fibre],
-                psf_parameters_slice)
+    # Evaluate the PSF for all fibres and slices in one go, then solve
+    # every slice's linear fit in a single vectorized pass
+    psf_array = psf_parameters_array.copy()
+    psf_array['flux'] = 1.0
+    psf_array['background'] = 0.0
+    psf_all = moffat_flux(psf_array, xfibre[good_fibre], yfibre[good_fibre])
+    flux, background, sigma_flux, sigma_background = extract_flux_all(
+        psf_all, ifu.data[good_fibre, :], ifu.var[good_fibre, :])
     if clip is not None:
         # Clip out discrepant data. Wavelength slices are targeted based on
         # their overall deviation from the model, but within a slice only
@@ -836,6 +1212,31 @@ def extract_total_flux(ifu, psf_parameters, model_name, clip=None):
             interp_over, interp_from, sigma_background[interp_from])
     return flux, background, sigma_flux, sigma_background
 
+def fit_flux_slice(model, data, variance):
+    """Weighted linear fit of (flux, background) to a single slice.
+
+    The model is linear in both parameters, so the weighted least
+    squares solution follows directly from the 2x2 normal equations;
+    no iterative optimizer is needed. The parameter uncertainties are
+    the square roots of the diagonal of the inverse normal matrix,
+    which is what the old curve_fit call boiled down to after its
+    covariance was divided by the reduced chi-squared.
+    """
+    weight = 1.0 / variance
+    s_w = weight.sum()
+    s_wm = (weight * model).sum()
+    s_wmm = (weight * model * model).sum()
+    s_wd = (weight * data).sum()
+    s_wmd = (weight * model * data).sum()
+    det = s_wmm * s_w - s_wm**2
+    if not np.isfinite(det) or det <= 0:
+        return np.nan, np.nan, np.nan, np.nan
+    flux = (s_w * s_wmd - s_wm * s_wd) / det
+    background = (s_wmm * s_wd - s_wm * s_wmd) / det
+    sigma_flux = np.sqrt(s_w / det)
+    sigma_background = np.sqrt(s_wmm / det)
+    return flux, background, sigma_flux, sigma_background
+
 def extract_flux_slice(data, variance, xpos, ypos, psf_parameters_slice):
     """Extract the flux from a single wavelength slice."""
     good_data = np.where(np.isfinite(data))[0]
@@ -843,31 +1244,11 @@ def extract_flux_slice(data, variance, xpos, ypos, psf_parameters_slice):
     if len(good_data) > 30:
         data = data[good_data]
         variance = variance[good_data]
-        noise = np.sqrt(variance)
         xpos = xpos[good_data]
         ypos = ypos[good_data]
         model = moffat_normalised(psf_parameters_slice, xpos, ypos)
-        # args = (model, data, variance)
-        # Initial guess for flux and background
-        guess = [np.sum(data), 0.0]
-        fitfunc = lambda x, flux, background: flux * model + background
-        result, covar = curve_fit(
-            fitfunc, np.arange(len(data)), data, guess, noise)
-        flux_slice, background_slice = result
-        reduced_chi2 = (
-            ((fitfunc(None, flux_slice, background_slice) - data) / noise)**2 /
-            (len(data) - 2)).sum()
-        try:
-            sigma_flux_slice, sigma_background_slice = np.sqrt(
-                covar[np.arange(2), np.arange(2)] / reduced_chi2)
-        except TypeError:
-            # covar wasn't returned as an array
-            flux_slice = np.nan
-            background_slice = np.nan
-            sigma_flux_slice = np.nan
-            sigma_background_slice = np.nan
-        # flux_slice, background_slice = leastsq(
-        #     residual_slice, guess, args=args)[0]
+        flux_slice, background_slice, sigma_flux_slice, \
+            sigma_background_slice = fit_flux_slice(model, data, variance)
     else:
         flux_slice = np.nan
         background_slice = np.nan
@@ -885,9 +1266,18 @@ def residual_slice(flux_background, model, data, variance):
     return ((background + flux * model) - data) / np.sqrt(variance)
 
 def save_transfer_function(path, transfer_function):
-    """Add the transfer function to a pre-existing FLUX_CALIBRATION HDU."""
-    # Open the file to update
-    hdulist = pf.open(path, 'update', do_not_scale_image_data=True)
+    """Add the transfer function to a pre-existing FLUX_CALIBRATION HDU.
+
+    `path` may also be an already-open HDUList (in update mode), in
+    which case the caller keeps ownership of the file handle.
+    """
+    if isinstance(path, pf.HDUList):
+        hdulist = path
+        close_hdulist = False
+    else:
+        # Open the file to update
+        hdulist = pf.open(path, 'update', do_not_scale_image_data=True)
+        close_hdulist = True
     hdu = hdulist['FLUX_CALIBRATION']
     data = hdu.data
     if len(data) == 4:
@@ -898,7 +1288,8 @@ def save_transfer_function(path, transfer_function):
         data[-1, :] = transfer_function
     # Save the data back into the FITS file
     hdu.data = data
-    hdulist.close()
+    if close_hdulist:
+        hdulist.close()
     return
 
 def read_standard_data(star):
@@ -949,32 +1340,56 @@ def take_ratio(standard_flux, standard_wavelength, observed_flux,
                             1.0 / ratio)
     return ratio
 
+_GAUSSIAN_KERNEL_CACHE = {}
+
+def _gaussian_kernel(width, radius):
+    """Return a normalised Gaussian kernel, cached across calls.
+
+    smooth_ratio is called once per file with the same width, so the
+    kernel only ever needs to be built once per (width, radius) pair.
+    """
+    key = (width, radius)
+    try:
+        return _GAUSSIAN_KERNEL_CACHE[key]
+    except KeyError:
+        offset = np.arange(-radius, radius + 1)
+        kernel = np.exp(-0.5 * (offset / width)**2)
+        kernel /= kernel.sum()
+        _GAUSSIAN_KERNEL_CACHE[key] = kernel
+        return kernel
+
 def smooth_ratio(ratio, width=10.0):
     """Smooth a ratio (or anything else, really). Uses Gaussian kernel."""
     # Get best behaviour at edges if done in terms of transmission, rather
     # than transfer function
     inverse = 1.0 / ratio
-    # Trim NaNs and infs from the ends (not any in the middle)
-    useful = np.where(np.isfinite(inverse))[0]
-    inverse_cut = inverse[useful[0]:useful[-1]+1]
-    good = np.isfinite(inverse_cut)
-    inverse_cut[~good] = np.interp(np.where(~good)[0], np.where(good)[0], 
-                                   inverse_cut[good])
-    # Extend the inverse ratio with a mirrored version. Not sure why this
-    # can't be done in gaussian_filter1d.
+    # Trim NaNs and infs from the ends (not any in the middle), reusing
+    # a single finite mask for the trim and the interpolation
+    finite_mask = np.isfinite(inverse)
+    useful = np.flatnonzero(finite_mask)
+    start, stop = useful[0], useful[-1] + 1
+    inverse_cut = inverse[start:stop]
+    good = finite_mask[start:stop]
+    bad_index = np.flatnonzero(~good)
+    if len(bad_index) > 0:
+        good_index = np.flatnonzero(good)
+        inverse_cut[bad_index] = np.interp(bad_index, good_index,
+                                           inverse_cut[good])
+    # Extend the inverse ratio with a mirrored version (odd reflection,
+    # 2*edge - mirror). Not sure why this can't be done in
+    # gaussian_filter1d.
     extra = int(np.round(3.0 * width))
-    inverse_extended = np.hstack(
-        (np.zeros(extra), inverse_cut, np.zeros(extra)))
-    inverse_extended[:extra] = 2*inverse_cut[0] - inverse_cut[extra+1:1:-1]
-    inverse_extended[-1*extra:] = (
-        2*inverse_cut[-1] - inverse_cut[-1:-1*(extra+1):-1])
-    # Do the actual smoothing
-    inverse_smoothed = gaussian_filter1d(inverse_extended, width, 
-                                         mode='nearest')
+    inverse_extended = np.pad(inverse_cut, extra, mode='reflect',
+                              reflect_type='odd')
+    # Do the actual smoothing with an FFT convolution against a cached
+    # kernel; the kernel radius matches the mirrored extension, so every
+    # retained sample sees real (or mirrored) data only
+    kernel = _gaussian_kernel(width, extra)
+    inverse_smoothed = fftconvolve(inverse_extended, kernel, mode='same')
     # Cut off the extras
     inverse_smoothed = inverse_smoothed[extra:-1*extra]
     # Insert back into the previous array
-    inverse[useful[0]:useful[-1]+1] = inverse_smoothed
+    inverse[start:stop] = inverse_smoothed
     # Undo the inversion
     smoothed = 1.0 / inverse
     return smoothed
@@ -1223,11 +1638,139 @@ def interpolate_flux_noise(flux, noise, good):
     interp_flux[still_bad] = np.nan
     return interp_flux, interp_noise
 
-def rebin_flux(target_wavelength, source_wavelength, source_flux):
-    """Rebin a flux onto a new wavelength grid."""
+if njit is not None:
+    @njit("void(f4[::1], f4[::1], f8[::1], f8[::1], f8[::1], f8[::1])",
+          parallel=True, cache=True, fastmath=True, nogil=True)
+    def _rebin_kernel(originalflux, originalweight, originalbinlimits,
+                      binlimits, out_flux, out_weight):
+        """Accumulate source flux into the new bins with scalar arithmetic.
+
+        Each output bin only writes its own out_flux[i]/out_weight[i],
+        so the outer loop runs in prange across cores; every iteration
+        locates its starting source bin with a binary search instead of
+        a pointer carried between iterations, and no index or weight
+        arrays are ever materialized.
+
+        The explicit signature forces compilation at import time and,
+        with cache=True, reuses the machine code cached on disk from
+        earlier runs -- so short-lived reduction processes never pay
+        the JIT latency on their first rebin.
+        """
+        n_orig = originalbinlimits.shape[0] - 1
+        for i in prange(out_flux.shape[0]):
+            low = binlimits[i]
+            high = binlimits[i + 1]
+            flux_acc = 0.0
+            weight_acc = 0.0
+            k = np.searchsorted(originalbinlimits, low, side='right') - 1
+            if k < 0:
+                k = 0
+            while k < n_orig and originalbinlimits[k] < high:
+                left = max(low, originalbinlimits[k])
+                right = min(high, originalbinlimits[k + 1])
+                if right > left:
+                    frac = ((right - left) /
+                            (originalbinlimits[k + 1] - originalbinlimits[k]))
+                    flux_acc += frac * originalflux[k]
+                    weight_acc += frac * originalweight[k]
+                k += 1
+            out_flux[i] = flux_acc
+            out_weight[i] = weight_acc
+else:
+    _rebin_kernel = None
+
+def build_rebin_matrix(source_bin_limits, target_bin_limits):
+    """Return the sparse rebinning matrix between two sets of bin limits.
+
+    R[i, j] is the fraction of source bin j falling in target bin i, so
+    rebinning is the linear map R @ flux -- one sparse matrix-vector
+    product, with the bin-boundary bookkeeping amortized over however
+    many spectra share the two grids.
+
+    Within a reduction run the same pair of wavelength grids comes up
+    for frame after frame, so the matrix is memoized on the raw bytes
+    of the two limit arrays: repeat calls cost a hash and a dict lookup
+    instead of rebuilding the matrix. Callers must not modify the
+    returned matrix in place.
+    """
+    return _build_rebin_matrix(
+        np.ascontiguousarray(source_bin_limits, dtype=np.float64).tobytes(),
+        np.ascontiguousarray(target_bin_limits, dtype=np.float64).tobytes())
+
+@functools.lru_cache(maxsize=8)
+def _build_rebin_matrix(source_bytes, target_bytes):
+    """Construct the rebinning matrix from the raw bytes of the limits."""
+    source_bin_limits = np.frombuffer(source_bytes)
+    target_bin_limits = np.frombuffer(target_bytes)
+    n_target = len(target_bin_limits) - 1
+    n_source = len(source_bin_limits) - 1
+    # First and last source bin overlapping each target bin
+    j_low = np.clip(
+        np.searchsorted(source_bin_limits, target_bin_limits[:-1],
+                        side='right') - 1,
+        0, n_source - 1)
+    j_high = np.clip(
+        np.searchsorted(source_bin_limits, target_bin_limits[1:],
+                        side='right') - 1,
+        0, n_source - 1)
+    counts = j_high - j_low + 1
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    # Source bin index for every nonzero entry, row by row
+    indices = (np.repeat(j_low, counts) + np.arange(indptr[-1]) -
+               np.repeat(indptr[:-1], counts))
+    # Fractional overlap of each (target, source) bin pair
+    left = np.maximum(np.repeat(target_bin_limits[:-1], counts),
+                      source_bin_limits[indices])
+    right = np.minimum(np.repeat(target_bin_limits[1:], counts),
+                       source_bin_limits[indices + 1])
+    data = (np.maximum(right - left, 0.0) /
+            (source_bin_limits[indices + 1] - source_bin_limits[indices]))
+    rebin_matrix = sparse.csr_matrix((data, indices, indptr),
+                                     shape=(n_target, n_source))
+    if CHECK_FLUX_CONSERVATION:
+        _check_flux_conservation(
+            rebin_matrix, source_bin_limits, target_bin_limits)
+    return rebin_matrix
+
+def _check_flux_conservation(rebin_matrix, source_bin_limits,
+                             target_bin_limits):
+    """Raise ValueError if the rebinning matrix does not conserve flux.
+
+    Every source bin lying fully within the target coverage must
+    distribute exactly all of its flux over the target bins, i.e. its
+    column sum in the matrix is 1. This replaces the old per-call
+    fraccounted bookkeeping: conservation is a property of the matrix,
+    so it is checked once per grid pair (under CHECK_FLUX_CONSERVATION)
+    rather than re-tallied for every spectrum.
+    """
+    column_sums = np.asarray(rebin_matrix.sum(axis=0)).ravel()
+    # Source bins sticking out past the target grid are legitimately
+    # only partially counted
+    inside = ((source_bin_limits[:-1] >= target_bin_limits[0]) &
+              (source_bin_limits[1:] <= target_bin_limits[-1]))
+    if not np.allclose(column_sums[inside], 1.0):
+        raise ValueError('Rebinning matrix does not conserve flux')
+
+def rebin_flux(target_wavelength, source_wavelength, source_flux,
+               out_flux=None, out_weight=None):
+    """Rebin a flux onto a new wavelength grid.
+
+    The wavelength axis must be the fastest-varying (last, contiguous)
+    axis of `source_flux`; anything else is copied into that layout
+    here, so callers holding transposed views should transpose once
+    upstream rather than paying for the copy on every call.
+
+    `out_flux` and `out_weight` are optional float64 buffers of length
+    len(target_wavelength): callers rebinning many spectra can pass the
+    same buffers every time and skip the per-call allocations. The
+    result is written into (and returned as) `out_flux`; `out_weight`
+    is scratch.
+    """
     targetwl = target_wavelength
-    originalwl = source_wavelength
-    originaldata = source_flux[1:-1]
+    # Unit stride along wavelength keeps the cumulative sums and the
+    # kernel's streaming reads prefetcher- and SIMD-friendly
+    originalwl = np.ascontiguousarray(source_wavelength)
+    originaldata = np.ascontiguousarray(source_flux)[1:-1]
     # The following is copy-pasted from the original fluxcal.py
     originalbinlimits = ( originalwl[ :-1 ] + originalwl[ 1: ] ) / 2.
     okaytouse = np.isfinite( originaldata )
@@ -1239,62 +1782,93 @@ def rebin_flux(target_wavelength, source_wavelength, source_flux):
     originalweight *= np.diff( originalbinlimits )
 
     nowlsteps = len( targetwl )
-    rebinneddata   = np.zeros( nowlsteps )
-    rebinnedweight = np.zeros( nowlsteps )
 
-    binlimits = np.array( [ np.nan ] * (nowlsteps+1) )
+    binlimits = np.empty( nowlsteps + 1 )
     binlimits[ 0 ] = targetwl[ 0 ]
     binlimits[ 1:-1 ] = ( targetwl[ 1: ] + targetwl[ :-1 ] ) / 2.
     binlimits[ -1 ] = targetwl[ -1 ]
-    binwidths = np.diff( binlimits )
-
-    origbinindex = np.interp( binlimits, originalbinlimits, 
-                              np.arange( originalbinlimits.shape[0] ),
-                              left=np.nan, right=np.nan )
-
-    fraccounted = np.zeros( originaldata.shape[0] )
-    # use fraccounted to check what fraction of each orig pixel is counted,
-    # and in this way check that flux is conserved.
-
-    maximumindex = np.max( np.where( np.isfinite( origbinindex ) ) )
-
-    for i, origindex in enumerate( origbinindex ):
-        if np.isfinite( origindex ) :
-            # deal with the lowest orig bin, which straddles the new lower limit
-            lowlimit = int( origindex )
-            lowfrac = 1. - ( origindex % 1 )
-            indices = np.array( [ lowlimit] )
-            weights = np.array( [ lowfrac ] )
-
-            # deal with the orig bins that fall entirely within the new bin
-            if np.isfinite( origbinindex[i+1] ):
-                intermediate = np.arange( int( origindex )+1, \
-                                      int(origbinindex[i+1]) )
-            else :
-                # XXX This is wrong: maximumindex is in the wrong scale
-                #intermediate = np.arange( int( origindex )+1, \
-                #                            maximumindex )
-                # This may also be wrong, but at least it doesn't crash
-                intermediate = np.arange(0)
-            indices = np.hstack( ( indices, intermediate ) )
-            weights = np.hstack( ( weights, np.ones( intermediate.shape ) ) )
-
-            # deal with the highest orig bin, which straddles the new upper limit
-            if np.isfinite( origbinindex[i+1] ):
-                upplimit = int( origbinindex[i+1] )
-                uppfrac = origbinindex[ i+1 ] % 1
-                indices = np.hstack( ( indices, np.array( [ upplimit ] ) ) )
-                weights = np.hstack( ( weights, np.array( [ uppfrac  ] ) ) )
-
-            fraccounted[ indices ] += weights
-            rebinneddata[ i ] = np.sum( weights * originalflux[indices] )
-            rebinnedweight[i ]= np.sum( weights * originalweight[indices] )
-
-    # now go back from total flux in each bin to flux per unit wavelength
-    rebinneddata = rebinneddata / rebinnedweight 
 
-    return rebinneddata
+    if out_flux is None:
+        out_flux = np.empty(nowlsteps)
+    if out_weight is None:
+        out_weight = np.empty(nowlsteps)
+
+    if _rebin_kernel is not None:
+        # Jitted path: fractional-overlap accumulation in one native
+        # loop with no temporary arrays at all. Flux and weight are
+        # stored as float32 -- halving the memory traffic of this
+        # memory-bound reduction -- while the bin limits and the
+        # accumulators stay float64, so the result is good to ~1e-7
+        # relative, far below detector noise.
+        _rebin_kernel(np.ascontiguousarray(originalflux, dtype=np.float32),
+                      np.ascontiguousarray(originalweight, dtype=np.float32),
+                      np.ascontiguousarray(originalbinlimits),
+                      binlimits, out_flux, out_weight)
+    else:
+        # Rebinning is a linear map: apply the sparse fractional-overlap
+        # matrix, which holds exactly the per-bin weights the old loop
+        # built up out of hstacked index and weight arrays
+        rebin_matrix = build_rebin_matrix(originalbinlimits, binlimits)
+        out_flux[:] = rebin_matrix @ originalflux
+        out_weight[:] = rebin_matrix @ originalweight
+
+    # New bins that stick out past the source coverage have no well
+    # defined flux. The old loop left most of these as 0/0; the bin
+    # truncated at the red end took a partial (and flagged-as-wrong)
+    # value. All such bins now come back NaN.
+    uncovered = ((binlimits[:-1] < originalbinlimits[0]) |
+                 (binlimits[1:] > originalbinlimits[-1]))
+
+    # Now go back from total flux in each bin to flux per unit
+    # wavelength. Only divide where there is weight, so empty bins
+    # never raise IEEE invalid-value warnings; they get an explicit
+    # NaN sentinel instead.
+    covered = out_weight > 0
+    np.divide(out_flux, out_weight, out=out_flux, where=covered)
+    out_flux[~covered] = np.nan
+    out_flux[uncovered] = np.nan
+
+    return out_flux
+
+
+def rebin_flux_many(target_wavelength, source_wavelength, source_flux):
+    """Rebin a stack of spectra that share one wavelength grid.
+
+    `source_flux` has shape (n_spectrum, n_wavelength). The sparse
+    rebinning matrix is built once and applied to every row, so the
+    bin-boundary bookkeeping is paid once rather than per spectrum.
+    Equivalent to calling rebin_flux on each row.
+    """
+    targetwl = target_wavelength
+    originalwl = np.ascontiguousarray(source_wavelength)
+    originaldata = np.ascontiguousarray(source_flux)[:, 1:-1]
+    originalbinlimits = (originalwl[:-1] + originalwl[1:]) / 2.
+    okaytouse = np.isfinite(originaldata)
 
+    originalweight = np.where(okaytouse, 1., 0.)
+    originaldata = np.where(okaytouse, originaldata, 0.)
+
+    originalflux = originaldata * np.diff(originalbinlimits)
+    originalweight *= np.diff(originalbinlimits)
+
+    nowlsteps = len(targetwl)
+    binlimits = np.empty(nowlsteps + 1)
+    binlimits[0] = targetwl[0]
+    binlimits[1:-1] = (targetwl[1:] + targetwl[:-1]) / 2.
+    binlimits[-1] = targetwl[-1]
+
+    rebin_matrix = build_rebin_matrix(originalbinlimits, binlimits)
+    rebinneddata = (rebin_matrix @ originalflux.T).T
+    rebinnedweight = (rebin_matrix @ originalweight.T).T
+
+    uncovered = ((binlimits[:-1] < originalbinlimits[0]) |
+                 (binlimits[1:] > originalbinlimits[-1]))
+    covered = rebinnedweight > 0
+    np.divide(rebinneddata, rebinnedweight, out=rebinneddata, where=covered)
+    rebinneddata[~covered] = np.nan
+    rebinneddata[:, uncovered] = np.nan
+
+    return rebinneddata
 
 def calc_eff_airmass(header,return_zd=False):
     """Calculate the effective airmass using observatory location, coordinates 
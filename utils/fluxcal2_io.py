@@ -43,7 +43,12 @@ def save_extracted_flux(path, observed_flux, observed_background,
                         sigma_flux, sigma_background,
                         star_match, psf_parameters, model_name,
                         good_psf, hdu_name='FLUX_CALIBRATION'):
-    """Add the extracted flux to the specified FITS file."""
+    """Add the extracted flux to the specified FITS file.
+
+    `path` may also be an already-open HDUList (in update mode), in
+    which case the caller keeps ownership of the file handle and no
+    extra open/close cycle happens here.
+    """
     # Turn the data into a single array
     data = np.vstack((observed_flux, observed_background, 
                       sigma_flux, sigma_background))
@@ -79,7 +84,12 @@ def save_extracted_flux(path, observed_flux, observed_background,
             # Probably tried to save an array, just ditch it
             pass
     # Update the file
-    hdulist = pf.open(path, 'update', do_not_scale_image_data=True)
+    if isinstance(path, pf.HDUList):
+        hdulist = path
+        close_hdulist = False
+    else:
+        hdulist = pf.open(path, 'update', do_not_scale_image_data=True)
+        close_hdulist = True
     # Check if there's already an extracted flux, and delete if so
     try:
         existing_index = hdulist.index_of(hdu_name)
@@ -88,8 +98,9 @@ def save_extracted_flux(path, observed_flux, observed_background,
     else:
         del hdulist[existing_index]
     hdulist.append(new_hdu)
-    hdulist.close()
-    del hdulist
+    if close_hdulist:
+        hdulist.close()
+        del hdulist
     return
 
 def header_translate(key):